@@ -80,6 +80,8 @@ if __name__ == "__main__":
     GOOGLE_BUILD_BASIC = get_reqs(lookup,'INSTALL_BASIC_GOOGLE_BUILD')
     GOOGLE_COMPUTE_BASIC = get_reqs(lookup,'INSTALL_BASIC_GOOGLE_COMPUTE')
     SWIFT_BASIC = get_reqs(lookup,'INSTALL_BASIC_SWIFT')
+    ASYNC_BASIC = get_reqs(lookup,'INSTALL_BASIC_ASYNC')
+    ASYNC_AIOHTTP_BASIC = get_reqs(lookup,'INSTALL_BASIC_ASYNC_AIOHTTP')
     TESTS_REQUIRES = get_reqs(lookup, 'TESTS_REQUIRES')
 
     # These requirement sets include sqlalchemy, for client+storage
@@ -126,6 +128,8 @@ if __name__ == "__main__":
               'registry-basic': [REGISTRY_BASIC],
               's3-basic': [S3_BASIC],
               'swift-basic': [SWIFT_BASIC],
+              'async': [ASYNC_BASIC],
+              'async-aiohttp': [ASYNC_AIOHTTP_BASIC],
               'all': [INSTALL_REQUIRES_ALL],
               'aws': [AWS],
               'dropbox': [DROPBOX],
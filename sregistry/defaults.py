@@ -94,6 +94,14 @@ SREGISTRY_THUMBNAIL = getenv('SREGISTRY_THUMBNAIL')
 
 SREGISTRY_WORKERS = int(getenv("SREGISTRY_PYTHON_THREADS", 9))
 
+# Seconds to wait to connect, and between bytes read, for worker requests
+SREGISTRY_CONNECT_TIMEOUT = float(getenv("SREGISTRY_CONNECT_TIMEOUT", 10))
+SREGISTRY_READ_TIMEOUT = float(getenv("SREGISTRY_READ_TIMEOUT", 60))
+
+# Download layers with asyncio in one process (needs httpx[http2] or aiohttp)
+SREGISTRY_ASYNC_DOWNLOAD = convert2boolean(getenv("SREGISTRY_ASYNC_DOWNLOAD",
+                                                  False))
+
 #########################
 # Database and Storage
 #########################
@@ -261,6 +261,17 @@ class SRegistryMessage:
     def debug(self, message):
         self.emit(DEBUG, message, 'DEBUG')
 
+    def is_debug(self):
+        '''is_debug returns true if debug messages are shown, check it to
+        skip formatting messages that would not be printed
+        '''
+        return self.isEnabledFor(DEBUG)
+
+    def is_verbose(self):
+        '''is_verbose returns true if verbose messages are shown
+        '''
+        return self.isEnabledFor(VERBOSE)
+
     def is_quiet(self):
         '''is_quiet returns true if the level is under 1
         '''
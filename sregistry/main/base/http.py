@@ -13,9 +13,12 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from requests.exceptions import HTTPError
 import requests
 
-from sregistry.utils import get_tmpfile
+from sregistry.utils import (
+    get_tmpfile,
+    json_loads,
+    move_file
+)
 from sregistry.logger import bot
-import shutil
 import json
 import sys
 
@@ -27,7 +30,8 @@ def delete(self, url,
 
     '''delete request, use with caution
     '''
-    bot.debug('DELETE %s' %url)
+    if bot.is_debug():
+        bot.debug('DELETE %s' %url)
     return self._call(url,
                       headers=headers,
                       func=requests.delete,
@@ -38,7 +42,8 @@ def delete(self, url,
 def head(self, url):
     '''head request, typically used for status code retrieval, etc.
     '''
-    bot.debug('HEAD %s' %url)
+    if bot.is_debug():
+        bot.debug('HEAD %s' %url)
     return self._call(url, func=requests.head)
 
 
@@ -67,7 +72,8 @@ def put(self, url,
 
     '''put request
     '''
-    bot.debug("PUT %s" %url)
+    if bot.is_debug():
+        bot.debug("PUT %s" %url)
     return self._call(url,
                       headers=headers,
                       func=requests.put,
@@ -85,7 +91,8 @@ def post(self,url,
     '''post will use requests to get a particular url
     '''
 
-    bot.debug("POST %s" %url)
+    if bot.is_debug():
+        bot.debug("POST %s" %url)
     return self._call(url,
                       headers=headers,
                       func=requests.post,
@@ -104,7 +111,8 @@ def get(self,url,
 
     '''get will use requests to get a particular url
     '''
-    bot.debug("GET %s" %url)
+    if bot.is_debug():
+        bot.debug("GET %s" %url)
     return self._call(url,
                       headers=headers,
                       func=requests.get,
@@ -184,7 +192,7 @@ def download(self, url,
         if isinstance(response, HTTPError):
             bot.exit("Error downloading %s, exiting." % url)
  
-        shutil.move(tmp_file, file_name)
+        move_file(tmp_file, file_name)
     else:
         bot.error("Invalid url or permissions %s" % url)
     return file_name
@@ -210,7 +218,8 @@ def stream(self, url,
         retry: should the client retry? (intended for use after token refresh)
                by default we retry once after token refresh, then fail.
     '''
-    bot.debug("GET %s" % url)
+    if bot.is_debug():
+        bot.debug("GET %s" % url)
 
     # Ensure headers are present, update if not
     if headers is None:
@@ -263,11 +272,13 @@ def stream_response(self, response, stream_to=None, show_progress=True):
         if show_progress is False:
             bot.quiet = True
  
-        # Keep user updated with Progress Bar, if not quiet
+        # Keep user updated with Progress Bar, if not quiet and in a terminal
         content_size = None
-        if 'Content-Length' in response.headers:
-            progress = 0
-            content_size = int(response.headers['Content-Length'])
+        progress = 0
+        last_bucket = -1
+        content_length = response.headers.get('Content-Length')
+        if content_length not in (None, '0') and sys.stdout.isatty():
+            content_size = int(content_length)
             bot.show_progress(progress, content_size, length=35)
 
         chunk_size = 1 << 20
@@ -275,11 +286,14 @@ def stream_response(self, response, stream_to=None, show_progress=True):
             for chunk in response.iter_content(chunk_size=chunk_size):
                 filey.write(chunk)
                 if content_size is not None:
-                    progress+=chunk_size
-                    bot.show_progress(iteration=progress,
-                                      total=content_size,
-                                      length=35,
-                                      carriage_return=False)
+                    progress += len(chunk)
+                    bucket = progress * 100 // content_size
+                    if bucket != last_bucket:
+                        last_bucket = bucket
+                        bot.show_progress(iteration=progress,
+                                          total=content_size,
+                                          length=35,
+                                          carriage_return=False)
 
         # Newline to finish download
         sys.stdout.write('\n')
@@ -363,7 +377,7 @@ def call(self, url, func, data=None,
         if return_json:
 
             try:
-                response = response.json()
+                response = json_loads(response.content)
             except ValueError:
                 bot.exit("The server returned a malformed response.")
 
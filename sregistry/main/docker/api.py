@@ -11,8 +11,11 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 from sregistry.defaults import SINGULARITY_CACHE
 from sregistry.logger import bot
 from sregistry.utils import ( 
+    get_partfile,
     get_tmpdir,    
     mkdir_p,
+    move_file,
+    parse_challenge,
     print_json
 )
 from .utils import (
@@ -23,9 +26,11 @@ import json
 import math
 import os
 import re
-import shutil
-import tempfile
 
+try:
+    from urllib.parse import urlencode # python 3.*
+except:
+    from urllib import urlencode # python 2.*
 
 ###############################################################################
 
@@ -41,21 +46,19 @@ def update_token(self, response):
     https://docs.docker.com/registry/spec/auth/token/
     '''
 
-    not_asking_auth = "Www-Authenticate" not in response.headers
-    if response.status_code != 401 or not_asking_auth:
+    challenge = response.headers.get('Www-Authenticate')
+    if response.status_code != 401 or not challenge:
         bot.exit("Authentication error, exiting.")
 
-    challenge = response.headers["Www-Authenticate"]
-    regexp = '^Bearer\s+realm="(.+)",service="(.+)",scope="(.+)",?'
-    match = re.match(regexp, challenge)
+    parsed = parse_challenge(challenge)
 
-    if not match:
+    if not parsed:
         bot.exit("Unrecognized authentication challenge, exiting.")
 
-    realm = match.group(1)
-    service = match.group(2)
-    scope = match.group(3).split(',')[0]
-    token_url = realm + '?service=' + service + '&expires_in=900&scope=' + scope
+    realm, service, scope = parsed
+    token_url = realm + '?' + urlencode({"service": service,
+                                         "expires_in": 900,
+                                         "scope": scope})
 
     # Default headers must be False so that client's current headers not used
     response = self._get(token_url)
@@ -167,7 +170,10 @@ def download_layers(self, repo_name, digest=None, destination=None):
         This function uses the MultiProcess client to download layers
         at the same time.
     '''
-    from sregistry.main.workers import ( Workers, download_task )
+    from sregistry.main.workers import ( Workers,
+                                         download_task,
+                                         download_tasks_async )
+    from sregistry.defaults import SREGISTRY_ASYNC_DOWNLOAD
 
     # 1. Get manifests if not retrieved
     if not hasattr(self, 'manifests'):
@@ -193,9 +199,12 @@ def download_layers(self, repo_name, digest=None, destination=None):
             tasks.append((url, self.headers, targz))
         layers.append(targz)
 
-    # Download layers with multiprocess workers
+    # Download layers with multiprocess workers, or asyncio if requested
     if len(tasks) > 0:
-        workers.run(func=download_task, tasks=tasks)
+        if SREGISTRY_ASYNC_DOWNLOAD:
+            download_tasks_async(tasks, concurrency=min(workers.workers, 5))
+        else:
+            workers.run(func=download_task, tasks=tasks)
 
     # Create the metadata tar
     metadata = self._create_metadata_tar(destination)
@@ -323,22 +332,27 @@ def get_layer(self, image_id, repo_name, download_folder=None):
     '''
     url = self._get_layerLink(repo_name, image_id)
 
-    bot.verbose("Downloading layers from %s" % url)
+    if bot.is_verbose():
+        bot.verbose("Downloading layers from %s" % url)
 
     download_folder = get_tmpdir(download_folder)
     download_folder = "%s/%s.tar.gz" % (download_folder, image_id)
 
     # Update user what we are doing
-    bot.debug("Downloading layer %s" % image_id)
+    if bot.is_debug():
+        bot.debug("Downloading layer %s" % image_id)
 
     # Step 1: Download the layer atomically
-    file_name = "%s.%s" % (download_folder,
-                           next(tempfile._get_candidate_names()))
+    file_name = get_partfile(download_folder)
 
     tar_download = self.download(url, file_name)
 
+    # The part file is created up front, empty if nothing was downloaded
     try:
-        shutil.move(tar_download, download_folder)
+        if os.path.getsize(tar_download) == 0:
+            os.remove(tar_download)
+            raise ValueError("empty layer %s" % tar_download)
+        move_file(tar_download, download_folder)
     except:
         msg = "Cannot untar layer %s," % tar_download
         msg += " was there a problem with download?"
@@ -12,9 +12,12 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from sregistry.defaults import DISABLE_SSL_CHECK
 from sregistry.logger import bot
+from sregistry.utils import (
+    get_partfile,
+    move_file
+)
 import os
 import requests
-import shutil
 import sys
 import tempfile
 
@@ -38,16 +41,16 @@ def download_task(url, headers, download_to, download_type='layer'):
 
     '''
     # Update the user what we are doing
-    bot.verbose("Downloading %s from %s" % (download_type, url))
+    if bot.is_verbose():
+        bot.verbose("Downloading %s from %s" % (download_type, url))
 
     # Step 1: Download the layer atomically
-    file_name = "%s.%s" % (download_to,
-                           next(tempfile._get_candidate_names()))
+    file_name = get_partfile(download_to)
 
     tar_download = download(url, file_name, headers=headers)
 
     try:
-        shutil.move(tar_download, download_to)
+        move_file(tar_download, download_to)
     except:
         msg = "Cannot untar layer %s," % tar_download
         msg += " was there a problem with download?"
@@ -84,7 +87,7 @@ def download(url, file_name, headers=None, show_progress=True):
         bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
 
     stream(url, headers=headers, stream_to=tmp_file)
-    shutil.move(tmp_file, file_name)
+    move_file(tmp_file, file_name)
     return file_name
 
 
@@ -93,7 +96,8 @@ def stream(url, headers, stream_to=None, retry=True):
        task, it differs from the client provided version in that it requires
        headers.
     '''
-    bot.debug("GET %s" % url)
+    if bot.is_debug():
+        bot.debug("GET %s" % url)
 
     if DISABLE_SSL_CHECK is True:
         bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
@@ -112,23 +116,28 @@ def stream(url, headers, stream_to=None, retry=True):
     # Successful Response
     elif response.status_code == 200:
 
-        # Keep user updated with Progress Bar
+        # Keep user updated with Progress Bar, only when writing to a terminal
         content_size = None
-        if 'Content-Length' in response.headers:
-            progress = 0
-            content_size = int(response.headers['Content-Length'])
-            bot.show_progress(progress,content_size,length=35)
+        progress = 0
+        last_bucket = -1
+        content_length = response.headers.get('Content-Length')
+        if content_length not in (None, '0') and sys.stdout.isatty():
+            content_size = int(content_length)
+            bot.show_progress(progress, content_size, length=35)
 
         chunk_size = 1 << 20
         with open(stream_to,'wb') as filey:
             for chunk in response.iter_content(chunk_size=chunk_size):
                 filey.write(chunk)
                 if content_size is not None:
-                    progress+=chunk_size
-                    bot.show_progress(iteration=progress,
-                                      total=content_size,
-                                      length=35,
-                                      carriage_return=False)
+                    progress += len(chunk)
+                    bucket = progress * 100 // content_size
+                    if bucket != last_bucket:
+                        last_bucket = bucket
+                        bot.show_progress(iteration=progress,
+                                          total=content_size,
+                                          length=35,
+                                          carriage_return=False)
 
         # Newline to finish download
         sys.stdout.write('\n')
@@ -8,18 +8,75 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 '''
 
-from sregistry.defaults import DISABLE_SSL_CHECK
+from sregistry.defaults import (
+    DISABLE_SSL_CHECK,
+    SREGISTRY_CONNECT_TIMEOUT,
+    SREGISTRY_READ_TIMEOUT
+)
 from sregistry.logger import bot
+from sregistry.utils import (
+    get_partfile,
+    json_loads,
+    parse_challenge
+)
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 import requests
+from urllib3.util.retry import Retry
+import urllib3
 
-import json
 import os
-import re
 import shutil
 import sys
-import tempfile
+import threading
+import time
+
+from urllib.parse import (
+    urlencode,
+    urlparse
+)
+
+
+# Certificate verification is decided once, warn here instead of per request
+_VERIFY = not DISABLE_SSL_CHECK
+if not _VERIFY:
+    bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# A stalled connection must not hang a worker, for streams the read timeout
+# is the longest wait between bytes
+_TIMEOUT = (SREGISTRY_CONNECT_TIMEOUT, SREGISTRY_READ_TIMEOUT)
+
+# Server errors (and connection errors) are retried by urllib3, with
+# exponential backoff, honoring Retry-After. The last response is returned.
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+_RETRY_METHODS = frozenset(["GET", "POST", "HEAD"])
+_RETRY_KWARGS = dict(total=5,
+                     backoff_factor=0.5,
+                     status_forcelist=_RETRY_STATUS,
+                     respect_retry_after_header=True,
+                     raise_on_status=False)
+if tuple(int(x) for x in urllib3.__version__.split('.')[:2]) >= (1, 26):
+    _RETRY = Retry(allowed_methods=_RETRY_METHODS, **_RETRY_KWARGS)
+else:
+    _RETRY = Retry(method_whitelist=_RETRY_METHODS, **_RETRY_KWARGS) # pylint: disable=unexpected-keyword-arg
+
+# Bearer tokens by (realm, service, scope) as (token, expires), and the last
+# challenge seen for each registry host, shared by threads of a worker
+_TOKEN_CACHE = {}
+_TOKEN_HOSTS = {}
+_TOKEN_LOCK = threading.Lock()
+
+# A single session per process lets consecutive calls to the same registry
+# (manifests, token endpoint, layers) reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16,
+                                       pool_maxsize=64,
+                                       max_retries=_RETRY))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16,
+                                      pool_maxsize=64,
+                                      max_retries=_RETRY))
 
 
 ################################################################################
@@ -41,22 +98,180 @@ def download_task(url, headers, destination, download_type='layer'):
 
     '''
     # Update the user what we are doing
-    bot.verbose("Downloading %s from %s" % (download_type, url))
+    if bot.is_verbose():
+        bot.verbose("Downloading %s from %s" % (download_type, url))
 
-    # Step 1: Download the layer atomically
-    file_name = "%s.%s" % (destination,
-                           next(tempfile._get_candidate_names()))
+    # Download the layer atomically, download renames on completion
+    return download(url, destination, headers=headers)
 
-    tar_download = download(url, file_name, headers=headers)
 
+def download_tasks_async(tasks, concurrency=5):
+    '''download a list of image layers concurrently in a single process,
+       an alternative to running download_task with the multiprocess Workers.
+       Each task is a tuple (url, headers, destination), the same that is
+       given to download_task. With httpx (and h2) the downloads share one
+       HTTP/2 connection per registry, otherwise aiohttp is required.
+
+       Parameters
+       ==========
+       tasks: a list of (url, headers, destination) tuples
+       concurrency: the maximum number of downloads to run at once
+    '''
+    httpx = aiohttp = None
+    try:
+        import httpx
+        import h2 # pylint: disable=unused-import
+    except ImportError:
+        httpx = None
+        try:
+            import aiohttp
+        except ImportError:
+            bot.exit("Install httpx[http2] or aiohttp to download layers "
+                     "asynchronously.")
+
+    import asyncio
+
+    total = len(tasks)
+    if total == 0:
+        return []
+
+    async def write_chunks(chunks, file_name):
+        with open(file_name, 'wb') as filey:
+            async for chunk in chunks:
+                filey.write(chunk)
+
+    async def fetch(session, url, headers, file_name):
+        '''stream a GET to file_name if successful, and return the status
+           with the authentication challenge, if any
+        '''
+        if httpx is not None:
+            async with session.stream('GET', url, headers=headers) as response:
+                if response.status_code == 200:
+                    await write_chunks(response.aiter_bytes(1 << 20), file_name)
+                return (response.status_code,
+                        response.headers.get('Www-Authenticate'))
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 200:
+                await write_chunks(response.content.iter_chunked(1 << 20),
+                                   file_name)
+            return response.status, response.headers.get('Www-Authenticate')
+
+    async def download_one(session, semaphore, url, headers, destination):
+
+        # Each task gets its own headers, a token update must not leak
+        headers = dict(add_cached_token(url, headers) or {})
+
+        async with semaphore:
+            if bot.is_verbose():
+                bot.verbose("Downloading layer from %s" % url)
+
+            file_name = get_partfile(destination)
+
+            # Don't leave the partial file if the download fails or exits
+            try:
+                for retry in [True, False]:
+                    status, challenge = await fetch(session, url, headers,
+                                                    file_name)
+
+                    # Deal with token if necessary, once
+                    if status == 401 and retry:
+                        loop = asyncio.get_event_loop()
+                        headers = await loop.run_in_executor(None,
+                                                             update_challenge,
+                                                             challenge,
+                                                             headers,
+                                                             url)
+                        continue
+                    break
+
+                # Exit once the loop is done, not from inside it
+                if status != 200:
+                    raise HTTPError("Invalid url or permissions %s, response %s"
+                                    % (url, status))
+
+                os.replace(file_name, destination)
+
+            except BaseException:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                raise
+
+        return destination
+
+    def get_session():
+        if httpx is not None:
+            return httpx.AsyncClient(
+                http2=True,
+                verify=_VERIFY,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=concurrency),
+                timeout=httpx.Timeout(SREGISTRY_READ_TIMEOUT,
+                                      connect=SREGISTRY_CONNECT_TIMEOUT))
+
+        if _VERIFY:
+            connector = aiohttp.TCPConnector(limit=concurrency)
+        else:
+            connector = aiohttp.TCPConnector(limit=concurrency, ssl=False)
+
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=SREGISTRY_CONNECT_TIMEOUT,
+                                        sock_read=SREGISTRY_READ_TIMEOUT)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def download_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        async with get_session() as session:
+            jobs = [asyncio.ensure_future(download_one(session, semaphore, *task))
+                    for task in tasks]
+            try:
+                return await asyncio.gather(*jobs)
+
+            # One failed, the others are stopped before the session closes
+            except Exception:
+                for job in jobs:
+                    job.cancel()
+                await asyncio.gather(*jobs, return_exceptions=True)
+                raise
+
+    # Not asyncio.run, which needs Python 3.7
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
-        shutil.move(tar_download, destination)
-    except:
-        msg = "Cannot untar layer %s," % tar_download
-        msg += " was there a problem with download?"
-        bot.exit(msg)
+        return loop.run_until_complete(download_all())
+    except HTTPError as error:
+        bot.exit(str(error))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class CountingReader(object):
+    '''CountingReader wraps a file object (e.g., response.raw) for
+       shutil.copyfileobj, counting the bytes read to update the progress
+       bar only when the percent complete changes.
+    '''
 
-    return destination
+    def __init__(self, fileobj, total=None):
+        self.fileobj = fileobj
+        self.total = total
+        self.progress = 0
+        self.last_bucket = -1
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress += len(data)
+
+        if self.total:
+            bucket = self.progress * 100 // self.total
+            if bucket != self.last_bucket:
+                self.last_bucket = bucket
+                bot.show_progress(iteration=self.progress,
+                                  total=self.total,
+                                  length=35,
+                                  carriage_return=False)
+        return data
 
 
 ################################################################################
@@ -70,30 +285,36 @@ def download_task(url, headers, destination, download_type='layer'):
 ################################################################################
 
 
-def post(url, headers=None, data=None, return_json=True):
+def post(url, headers=None, data=None, return_json=True, json_payload=None):
     '''post will use requests to get a particular url
     '''
-    bot.debug("POST %s" %url)
+    if bot.is_debug():
+        bot.debug("POST %s" %url)
     return call(url,
                 headers=headers,
-                func=requests.post,
+                func=_SESSION.post,
                 data=data,
+                json_payload=json_payload,
                 return_json=return_json)
 
 
-def get(url, headers=None, token=None, data=None, return_json=True):
+def get(url, headers=None, token=None, data=None, return_json=True,
+        json_payload=None):
     '''get will use requests to get a particular url
     '''
-    bot.debug("GET %s" %url)
+    if bot.is_debug():
+        bot.debug("GET %s" %url)
     return call(url,
                 headers=headers,
-                func=requests.get,
+                func=_SESSION.get,
                 data=data,
+                json_payload=json_payload,
                 return_json=return_json)
         
 
 def download(url, file_name, headers=None, show_progress=True):
-    '''stream to a temporary file, rename on successful completion
+    '''stream to a temporary file, rename on successful completion. The
+        temporary file is next to file_name so the rename is atomic.
 
         Parameters
         ==========
@@ -101,25 +322,29 @@ def download(url, file_name, headers=None, show_progress=True):
         url: the url to stream from
         headers: additional headers to add
     '''
+    tmp_file = get_partfile(file_name)
 
-    fd, tmp_file = tempfile.mkstemp(prefix=("%s.tmp." % file_name)) 
-    os.close(fd)
-
-    if DISABLE_SSL_CHECK is True:
-        bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
-
-    verify = not DISABLE_SSL_CHECK
+    # Don't leave the partial file if the download fails or exits
+    try:
 
-    # Does the url being requested exist?
-    if requests.head(url, verify=verify).status_code in [200, 401]:
+        # stream exits for a missing url or permissions, no need to check first
         response = stream(url, headers=headers, stream_to=tmp_file)
 
         if isinstance(response, HTTPError):
             bot.exit("Error downloading %s, exiting." %url)
 
-        shutil.move(tmp_file, file_name)
-    else:
-        bot.error("Invalid url or permissions %s" %url)
+        try:
+            os.replace(tmp_file, file_name)
+        except OSError:
+            msg = "Cannot untar layer %s," % tmp_file
+            msg += " was there a problem with download?"
+            bot.exit(msg)
+
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
     return file_name
 
 
@@ -129,54 +354,57 @@ def stream(url, headers, stream_to=None, retry=True):
        headers.
     '''
 
-    bot.debug("GET %s" %url)
+    if bot.is_debug():
+        bot.debug("GET %s" %url)
+
+    # Use a token already fetched for this registry, if we have one
+    headers = add_cached_token(url, headers)
 
-    if DISABLE_SSL_CHECK is True:
-        bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
+    while True:
+        response = _SESSION.get(url,
+                                headers=headers,
+                                verify=_VERIFY,
+                                timeout=_TIMEOUT,
+                                stream=True)
 
-    # Ensure headers are present, update if not
-    response = requests.get(url,         
-                            headers=headers,
-                            verify=not DISABLE_SSL_CHECK,
-                            stream=True)
+        # Deal with token if necessary, once
+        if response.status_code == 401 and retry is True:
+            response.close()
+            headers = update_token(response, headers)
+            retry = False
+            continue
 
-    # Deal with token if necessary
-    if response.status_code == 401 and retry is True:
-        headers = update_token(response, headers)
-        return stream(url, headers, stream_to, retry=False)
+        break
 
     if response.status_code == 200:
 
-        # Keep user updated with Progress Bar
+        # Keep user updated with Progress Bar, only when writing to a terminal
         content_size = None
-        if 'Content-Length' in response.headers:
-            progress = 0
-            content_size = int(response.headers['Content-Length'])
-            bot.show_progress(progress,content_size,length=35)
-
-        chunk_size = 1 << 20
-        with open(stream_to,'wb') as filey:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                filey.write(chunk)
-                if content_size is not None:
-                    progress+=chunk_size
-                    bot.show_progress(iteration=progress,
-                                      total=content_size,
-                                      length=35,
-                                      carriage_return=False)
+        content_length = response.headers.get('Content-Length')
+        if content_length not in (None, '0') and sys.stdout.isatty():
+            content_size = int(content_length)
+            bot.show_progress(0, content_size, length=35)
+
+        # Read the raw socket in large blocks, urllib3 still decodes gzip
+        response.raw.decode_content = True
+        reader = CountingReader(response.raw, total=content_size)
+
+        with open(stream_to, 'wb') as filey:
+            shutil.copyfileobj(reader, filey, length=1 << 20)
 
         # Newline to finish download
         sys.stdout.write('\n')
 
         return stream_to 
 
-    bot.exit("Problem with stream, response %s" % response.status_code)
+    bot.exit("Invalid url or permissions %s, response %s" % (url,
+                                                            response.status_code))
 
 
 
 def call(url, func, data=None, headers=None, 
                     return_json=True, stream=False, 
-                    retry=True):
+                    retry=True, json_payload=None):
 
     '''call will issue the call, and issue a refresh token
     given a 401 response, and if the client has a _update_token function
@@ -186,46 +414,43 @@ def call(url, func, data=None, headers=None,
     func: the function (eg, post, get) to call
     url: the url to send file to
     headers: headers for the request
-    data: additional data to add to the request
+    data: additional data to add to the request (form encoded, or as is)
     return_json: return json if successful
+    json_payload: a document to send as the json body of the request
     '''
- 
-    if DISABLE_SSL_CHECK is True:
-        bot.warning('Verify of certificates disabled! ::TESTING USE ONLY::')
 
-    if data is not None:
-        if not isinstance(data,dict):
-            data = json.dumps(data)
+    # Use a token already fetched for this registry, if we have one
+    headers = add_cached_token(url, headers)
+
+    while True:
+        response = func(url=url,
+                        headers=headers,
+                        data=data,
+                        json=json_payload,
+                        verify=_VERIFY,
+                        timeout=_TIMEOUT,
+                        stream=stream)
+
+        # Errored response, try again once with refreshed token
+        if response.status_code == 401 and retry is True:
+            headers = update_token(response, headers)
+            retry = False
+            continue
 
-    response = func(url=url,
-                    headers=headers,
-                    data=data,
-                    verify=not DISABLE_SSL_CHECK,
-                    stream=stream)
+        break
 
-    # Errored response, try again with refresh
-    if response.status_code in [500, 502]:
+    # Errored response, out of retries
+    if response.status_code in _RETRY_STATUS:
         bot.exit("Beep boop! %s: %s" %(response.reason,
                                        response.status_code))
 
-    # Errored response, try again with refresh
+    # Errored response, not found
     if response.status_code == 404:
         bot.exit("Beep boop! %s: %s" %(response.reason,
                                        response.status_code))
 
-    # Errored response, try again with refresh
+    # Errored response, token was already refreshed
     if response.status_code == 401:
-
-        # If client has method to update token, try it once
-        if retry is True:
-
-            # A result of None indicates no update to the call
-            headers = update_token(response, headers)
-            return call(url, func, data=data,
-                        headers=headers,
-                        return_json=return_json,
-                        stream=stream, retry=False)
-
         bot.exit("Your credentials are expired! %s: %s" %(response.reason,
                                                           response.status_code))
 
@@ -234,7 +459,7 @@ def call(url, func, data=None, headers=None,
         if return_json:
 
             try:
-                response = response.json()
+                response = json_loads(response.content)
             except ValueError:
                 bot.exit("The server returned a malformed response.")
 
@@ -252,31 +477,95 @@ def update_token(response, headers):
     
     '''
 
-    not_asking_auth = "Www-Authenticate" not in response.headers
-    if response.status_code != 401 or not_asking_auth:
+    challenge = response.headers.get('Www-Authenticate')
+    if response.status_code != 401 or not challenge:
+        bot.exit("Authentication error, exiting.")
+
+    return update_challenge(challenge, headers, url=response.url)
+
+
+def update_challenge(challenge, headers, url=None):
+    '''update_challenge parses a Www-Authenticate Bearer challenge, requests
+    a token from the realm it names, and adds it to the headers. It is
+    separate from update_token so that responses that are not from requests
+    (e.g., aiohttp) can be handled too.
+
+    Parameters
+    ==========
+    challenge: the value of the Www-Authenticate response header
+    headers: the refused request's headers, copied to add the token
+    url: the url that was refused, to reuse the token for its host
+
+    '''
+    headers = dict(headers or {})
+
+    if not challenge:
         bot.exit("Authentication error, exiting.")
 
-    challenge = response.headers["Www-Authenticate"]
-    regexp = '^Bearer\s+realm="(.+)",service="(.+)",scope="(.+)",?'
-    match = re.match(regexp, challenge)
+    parsed = parse_challenge(challenge)
 
-    if not match:
+    if not parsed:
         bot.exit("Unrecognized authentication challenge, exiting.")
 
-    realm = match.group(1)
-    service = match.group(2)
-    scope = match.group(3).split(',')[0]
+    realm, service, scope = parsed
+    key = (realm, service, scope)
 
-    token_url = realm + '?service=' + service + '&expires_in=900&scope=' + scope
+    # Only one request for a token per challenge, reused until near expiry
+    with _TOKEN_LOCK:
+        token, expires = _TOKEN_CACHE.get(key, (None, 0))
 
-    response = get(token_url)
+        # The server just refused the cached token, don't offer it again
+        if headers.get("Authorization") == "Bearer %s" % token:
+            token = None
 
-    try:
-        token = response["token"]
-        token = {"Authorization": "Bearer %s" % token}
-        headers.update(token)
+        if token is None or time.time() >= expires - 30:
+            token_url = realm + '?' + urlencode({"service": service,
+                                                 "expires_in": 900,
+                                                 "scope": scope})
+
+            # Not through call, a refused token request must not refresh
+            if bot.is_debug():
+                bot.debug("GET %s" % token_url)
+            response = _SESSION.get(token_url, verify=_VERIFY, timeout=_TIMEOUT)
+
+            try:
+                response = json_loads(response.content)
+                token = response["token"]
+                expires = time.time() + response.get("expires_in", 900)
+            except:
+                bot.exit("Error getting token.")
+
+            _TOKEN_CACHE[key] = (token, expires)
+
+        if url is not None:
+            _TOKEN_HOSTS[urlparse(url).netloc] = key
+
+    headers["Authorization"] = "Bearer %s" % token
+    return headers
+
+
+def add_cached_token(url, headers):
+    '''add_cached_token adds the last unexpired token used for the host of
+    the url to the headers, so that most requests do not first need to be
+    refused with a 401 to get one. The headers are copied if changed. A
+    token the caller set is kept, the cached one may be for another scope.
+
+    Parameters
+    ==========
+    url: the url that the headers will be sent to
+    headers: the headers for the request, or None
+
+    '''
+    if headers and "Authorization" in headers:
+        return headers
+
+    with _TOKEN_LOCK:
+        key = _TOKEN_HOSTS.get(urlparse(url).netloc)
+        token, expires = _TOKEN_CACHE.get(key, (None, 0))
 
-    except:
-        bot.exit("Error getting token.")
+    if token is None or time.time() >= expires - 30:
+        return headers
 
+    headers = dict(headers or {})
+    headers["Authorization"] = "Bearer %s" % token
     return headers
@@ -112,6 +112,21 @@ def test_parse_image_name():
     assert names['storage'] == 'library/ubuntu:latest@version.sif'
 
 
+def test_parse_challenge():
+    '''the Www-Authenticate challenge values should stop at their closing
+    quote, even when more parameters follow'''
+    print("Testing utils.parse_challenge")
+    from sregistry.utils import parse_challenge
+    challenge = ('Bearer realm="https://auth.docker.io/token",'
+                 'service="registry.docker.io",'
+                 'scope="repository:library/ubuntu:pull",'
+                 'error="insufficient_scope"')
+    assert parse_challenge(challenge) == ("https://auth.docker.io/token",
+                                          "registry.docker.io",
+                                          "repository:library/ubuntu:pull")
+    assert parse_challenge('Basic realm="registry"') is None
+
+
 def test_recipe_tag():
     print("Testing utils.get_recipe_tag")
     from sregistry.utils import get_recipe_tag
@@ -192,6 +207,49 @@ def test_copyfile(tmp_path):
     assert os.path.exists(original)
     assert os.path.exists(dest)
 
+def test_move_file(tmp_path):
+    print("Testing utils.move_file")
+    import errno
+    from unittest import mock
+    from sregistry.utils import move_file, write_file, read_file
+    original = str(tmp_path / 'location1.txt')
+    dest = str(tmp_path / 'location2.txt')
+    write_file(original, "CONTENT IN FILE")
+    move_file(original, dest)
+    assert not os.path.exists(original)
+    assert read_file(dest)[0] == "CONTENT IN FILE"
+
+    # Across filesystems the rename fails with EXDEV, and is copied instead
+    replace = os.replace
+    def cross_device(source, destination):
+        if not source.endswith('.part'):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        return replace(source, destination)
+    with mock.patch('os.replace', cross_device):
+        move_file(dest, original)
+    assert os.listdir(str(tmp_path)) == ['location1.txt']
+    assert read_file(original)[0] == "CONTENT IN FILE"
+
+    # A failed copy is raised, and leaves no partial file behind
+    def no_space(*args):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    with mock.patch('os.replace', cross_device):
+        with mock.patch('os.copy_file_range', no_space, create=True):
+            with pytest.raises(OSError):
+                move_file(original, dest)
+    assert os.listdir(str(tmp_path)) == ['location1.txt']
+
+def test_get_partfile(tmp_path):
+    print("Testing utils.get_partfile")
+    from sregistry.utils import get_partfile
+    dest = str(tmp_path / 'layer.tar.gz')
+    partfile = get_partfile(dest)
+    assert os.path.exists(partfile)
+    assert os.path.dirname(partfile) == str(tmp_path)
+    assert os.path.basename(partfile).startswith('layer.tar.gz.')
+    assert partfile.endswith('.part')
+    assert get_partfile(dest) != partfile
+
 def test_get_tmpdir_tmpfile():
     print("Testing utils.get_tmpdir, get_tmpfile")
     from sregistry.utils import get_tmpdir, get_tmpfile
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# Copyright (C) 2019 Vanessa Sochat.
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import http.server
+import os
+import socketserver
+import sys
+import threading
+import pytest
+
+
+BLOB = b'layer content' * 1000
+
+
+@pytest.fixture
+def registry():
+    '''a local registry that redirects blob requests elsewhere, as Docker Hub
+    does to its CDN'''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, *args): # pylint: disable=arguments-differ
+            pass
+
+        def do_GET(self): # pylint: disable=invalid-name
+            if self.path.startswith('/v2/blobs/'):
+                self.send_response(307)
+                self.send_header('Location', '/cdn/' + self.path.split('/')[-1])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif self.path.startswith('/cdn/'):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(BLOB)))
+                self.end_headers()
+                self.wfile.write(BLOB)
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%s' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['httpx', 'aiohttp'])
+def async_backend(request, monkeypatch):
+    '''run the async download with each client, httpx is preferred so it is
+    hidden from the import to test aiohttp'''
+    if request.param == 'httpx':
+        pytest.importorskip('httpx')
+        pytest.importorskip('h2')
+    else:
+        pytest.importorskip('aiohttp')
+        monkeypatch.setitem(sys.modules, 'httpx', None)
+    return request.param
+
+
+def test_download_tasks_async_redirect(tmp_path, registry, async_backend):
+    '''blob downloads should follow a redirect, with either client'''
+    print("Testing workers.tasks.download_tasks_async with %s" % async_backend)
+    from sregistry.main.workers.tasks import download_tasks_async
+    tasks = [('%s/v2/blobs/sha256:%s' % (registry, i),
+              {},
+              str(tmp_path / ('%s.tar.gz' % i))) for i in range(3)]
+    finished = download_tasks_async(tasks)
+    assert finished == [task[2] for task in tasks]
+    for destination in finished:
+        with open(destination, 'rb') as filey:
+            assert filey.read() == BLOB
+    assert sorted(os.listdir(str(tmp_path))) == ['0.tar.gz',
+                                                 '1.tar.gz',
+                                                 '2.tar.gz']
+
+
+def test_download_tasks_async_cleanup(tmp_path, registry, async_backend):
+    '''a failed download should exit without leaving a partial file'''
+    print("Testing workers.tasks.download_tasks_async cleanup")
+    from sregistry.main.workers.tasks import download_tasks_async
+    tasks = [('%s/v2/missing' % registry, {}, str(tmp_path / 'a.tar.gz'))]
+    with pytest.raises(SystemExit):
+        download_tasks_async(tasks)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_task_cleanup(tmp_path, registry):
+    '''a failed download in a worker should not leave a partial file'''
+    print("Testing workers.tasks.download_task cleanup")
+    from sregistry.main.workers.tasks import download_task
+    with pytest.raises(SystemExit):
+        download_task('%s/v2/missing' % registry, {}, str(tmp_path / 'a.tar.gz'))
+    assert os.listdir(str(tmp_path)) == []
+
+
+CHALLENGE = ('Bearer realm="https://auth.example.com/token",'
+             'service="registry.example.com",'
+             'scope="repository:library/ubuntu:pull"')
+
+
+@pytest.fixture
+def token_server(monkeypatch):
+    '''an empty token cache, with token requests answered by a counter so
+    each fetch hands out a new token'''
+    from sregistry.main.workers import tasks
+    monkeypatch.setattr(tasks, '_TOKEN_CACHE', {})
+    monkeypatch.setattr(tasks, '_TOKEN_HOSTS', {})
+
+    class Response:
+        def __init__(self, content):
+            self.content = content
+
+    class Server:
+        expires_in = 900
+        requested = []
+
+        def get(self, url, **kwargs): # pylint: disable=unused-argument
+            self.requested.append(url)
+            return Response(('{"token": "t%s", "expires_in": %s}' % (
+                len(self.requested), self.expires_in)).encode())
+
+    server = Server()
+    server.requested = []
+    monkeypatch.setattr(tasks._SESSION, 'get', server.get) # pylint: disable=protected-access
+    return server
+
+
+def test_update_challenge_cache(token_server):
+    '''a token is fetched once per scope and reused until near its expiry'''
+    print("Testing workers.tasks.update_challenge cache")
+    from sregistry.main.workers.tasks import update_challenge
+    headers = update_challenge(CHALLENGE, None)
+    assert headers == {"Authorization": "Bearer t1"}
+    headers = update_challenge(CHALLENGE, {"Accept": "*/*"})
+    assert headers == {"Accept": "*/*", "Authorization": "Bearer t1"}
+    assert len(token_server.requested) == 1
+    assert "scope=repository%3Alibrary%2Fubuntu%3Apull" in token_server.requested[0]
+
+
+def test_update_challenge_expiry(token_server):
+    '''a token within 30 seconds of expiry is fetched again'''
+    print("Testing workers.tasks.update_challenge expiry")
+    from sregistry.main.workers.tasks import update_challenge
+    token_server.expires_in = 20
+    assert update_challenge(CHALLENGE, {}) == {"Authorization": "Bearer t1"}
+    assert update_challenge(CHALLENGE, {}) == {"Authorization": "Bearer t2"}
+    assert len(token_server.requested) == 2
+
+
+def test_update_challenge_rejected(token_server):
+    '''a cached token that the registry refused is replaced'''
+    print("Testing workers.tasks.update_challenge after a 401")
+    from sregistry.main.workers.tasks import update_challenge
+    headers = update_challenge(CHALLENGE, {})
+    refused = dict(headers)
+    headers = update_challenge(CHALLENGE, headers)
+    assert headers == {"Authorization": "Bearer t2"}
+    assert refused == {"Authorization": "Bearer t1"}
+    assert len(token_server.requested) == 2
+
+
+def test_add_cached_token(token_server):
+    '''the cached token is only attached to the host that asked for it'''
+    print("Testing workers.tasks.add_cached_token")
+    from sregistry.main.workers.tasks import update_challenge, add_cached_token
+    url = 'https://registry.example.com/v2/library/ubuntu/manifests/latest'
+    assert add_cached_token(url, {}) == {}
+    update_challenge(CHALLENGE, {}, url=url)
+    headers = {"Accept": "*/*"}
+    assert add_cached_token(url, headers) == {"Accept": "*/*",
+                                              "Authorization": "Bearer t1"}
+    assert headers == {"Accept": "*/*"}
+    assert add_cached_token('https://cdn.example.com/blob', {}) == {}
+    headers = {"Authorization": "Bearer client"}
+    assert add_cached_token(url, headers) == {"Authorization": "Bearer client"}
+    assert len(token_server.requested) == 1
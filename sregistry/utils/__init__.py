@@ -10,6 +10,7 @@ from .terminal import (
 from .names import (
     get_recipe_tag,
     get_uri,
+    parse_challenge,
     parse_image_name,
     remove_uri
 )
@@ -18,9 +19,12 @@ from .fileio import (
     extract_tar,
     get_userhome,
     get_file_hash,
+    get_partfile,
     get_tmpdir,
     get_tmpfile,
+    json_loads,
     mkdir_p,
+    move_file,
     print_json,
     read_file,
     read_json,
@@ -18,6 +18,12 @@ import tempfile
 import json
 from sregistry.logger import bot
 
+# Parses responses for the clients, orjson is faster for large manifests
+try:
+    from orjson import loads as json_loads # pylint: disable=unused-import
+except ImportError:
+    from json import loads as json_loads
+
 
 ################################################################################
 ## FOLDER OPERATIONS ###########################################################
@@ -63,6 +69,22 @@ def get_tmpfile(requested_tmpdir=None, prefix=""):
     return tmp_file
 
 
+def get_partfile(destination):
+    '''get a new, unique temporary file next to a destination, so it can
+       be renamed to it atomically when complete. The file is closed (and
+       just a name returned).
+
+       Parameters
+       ==========
+       destination: the final path that the temporary file is for
+    '''
+    fd, part_file = tempfile.mkstemp(dir=os.path.dirname(destination) or '.',
+                                     prefix="%s." % os.path.basename(destination),
+                                     suffix='.part')
+    os.close(fd)
+    return part_file
+
+
 def get_tmpdir(requested_tmpdir=None, prefix="", create=True):
     '''get a temporary directory for an operation. If SREGISTRY_TMPDIR
        is set, return that. Otherwise, return the output of tempfile.mkdtemp
@@ -194,6 +216,54 @@ def copyfile(source, destination, force=True):
     return destination
 
 
+# copy_file_range is unsupported, or not across these filesystems
+_COPY_FILE_RANGE_ERRNOS = (errno.EXDEV,
+                           errno.ENOSYS,
+                           errno.EINVAL,
+                           errno.EOPNOTSUPP)
+
+
+def move_file(source, destination):
+    '''move a file to its destination, atomically. On the same filesystem
+       this is a rename. Across filesystems (e.g., a tmpfs /tmp) the content
+       is copied in the kernel to a temporary file next to the destination,
+       which is then renamed, and the source removed.
+    '''
+    try:
+        os.replace(source, destination)
+        return destination
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp_file = get_partfile(destination)
+    try:
+        try:
+            with open(source, 'rb') as src, open(tmp_file, 'wb') as dst:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                    pass
+
+        # Python < 3.8, or a kernel or filesystem without copy_file_range,
+        # shutil uses sendfile where it can
+        except AttributeError:
+            shutil.copyfile(source, tmp_file)
+        except OSError as e:
+            if e.errno not in _COPY_FILE_RANGE_ERRNOS:
+                raise
+            shutil.copyfile(source, tmp_file)
+
+        os.replace(tmp_file, destination)
+
+    # Don't leave the partial copy behind
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    os.remove(source)
+    return destination
+
+
 def write_file(filename, content, mode="w"):
     '''write_file will open a file, "filename" and write content, "content"
        and properly close the file
@@ -39,6 +39,20 @@ _default_uri = re.compile(
     "(?:@(?P<version>.+))?"
     "$")
 
+# Bearer token challenge, each value stops at its closing quote
+_challenge = re.compile(
+    r'Bearer\s+realm="([^"]+)",service="([^"]+)",scope="([^"]+)"')
+
+
+def parse_challenge(challenge):
+    '''parse a Www-Authenticate Bearer challenge into its realm, service
+       and scope, or return None if it isn't one.
+    '''
+    match = _challenge.match(challenge)
+    if match:
+        return match.groups()
+    return None
+
 
 def set_default(item, default, use_default):
     '''if an item provided is None and boolean use_default is set to True,
@@ -85,6 +85,17 @@ INSTALL_BASIC_S3 = (
     ('boto3', {'min_version': '1.7.83'}),
 )
 
+# Optional, faster layer downloads with SREGISTRY_ASYNC_DOWNLOAD
+INSTALL_BASIC_ASYNC = (
+    ('httpx[http2]', {'min_version': '0.20.0'}),
+    ('orjson', {'min_version': '3.0.0'}),
+)
+
+INSTALL_BASIC_ASYNC_AIOHTTP = (
+    ('aiohttp', {'min_version': '3.3.0'}),
+    ('orjson', {'min_version': '3.0.0'}),
+)
+
 INSTALL_BASIC_ALL = (INSTALL_REQUIRES +
                      INSTALL_BASIC_S3 +
                      INSTALL_BASIC_AWS +